@@ -4,13 +4,15 @@
 
 """Charm the application."""
 
+import hashlib
+import hmac
+import io
 import logging
 import os
 import shutil
-import textwrap
-from hashlib import sha256
+import tempfile
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union, cast
 from urllib import request
 from urllib.error import HTTPError
 
@@ -27,11 +29,59 @@ from charms.operator_libs_linux.v1.systemd import (
 from ops.model import ModelError
 from ops.pebble import APIError
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: nocover
+    # libyaml bindings are not available; fall back to the pure-Python loader
+    from yaml import SafeLoader
+
 logger = logging.getLogger(__name__)
 
 EXPORTER_PORT = 9469
 EXPORTER_BINARY_URL = "https://github.com/ricoberger/script_exporter/releases/download/v2.15.1/script_exporter-linux-amd64"
 EXPORTER_BINARY_SHA = "e7962a9863c015f721e3cec9af24c85e6b93be79ff992230d9d12029c89f456f"
+# The relabel configs come from the official Script Exporter docs; please refer
+# to that for further information on what they do
+RELABEL_CONFIGS = (
+    {"source_labels": ["__address__"], "target_label": "__param_target"},
+    {"source_labels": ["__param_target"], "target_label": "instance"},
+    # Copy the scrape job target to an extra label for dashboard usage
+    {"source_labels": ["__param_target"], "target_label": "script_target"},
+    # Set the address to scrape to the script exporter url
+    {"target_label": "__address__", "replacement": f"localhost:{EXPORTER_PORT}"},
+)
+SYSTEMD_UNIT = """
+[Unit]
+Description=Prometheus Script exporter
+Wants=network-online.target
+After=network-online.target
+
+[Service]
+LimitNPROC=infinity
+LimitNOFILE=infinity
+ExecStart=/usr/local/bin/script_exporter --config.file=/etc/script-exporter.yaml
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+"""
+# Size of the chunks used when streaming the exporter binary to disk or through the hasher
+READ_CHUNK_SIZE = 256 * 1024
+NO_CONFIG_FILE_STATUS = ops.BlockedStatus('Please set the "config_file" config variable')
+NO_SCRIPT_FILE_STATUS = ops.BlockedStatus('Please set the "script_file" config variable')
+NO_PROMETHEUS_CONFIG_FILE_STATUS = ops.BlockedStatus(
+    'Please set the "prometheus_config_file" config variable'
+)
+
+
+def _file_sha256(f: io.BufferedReader) -> str:
+    """Compute the sha256 hex digest of a binary file object without reading it all in memory."""
+    if hasattr(hashlib, "file_digest"):  # Python 3.11+
+        return hashlib.file_digest(f, "sha256").hexdigest()
+    digest = hashlib.sha256()
+    while chunk := f.read(READ_CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
 
 
 class ScriptExporterCharm(ops.CharmBase):
@@ -44,6 +94,7 @@ class ScriptExporterCharm(ops.CharmBase):
         self._config_path = "/etc/script-exporter-config.yaml"
         self._binary_path = "/usr/local/bin/script_exporter"
         self._binary_resource_name = "script-exporter-binary"
+        self._service_path = "/etc/systemd/system/script-exporter.service"
 
         self.cos_agent = COSAgentProvider(
             charm=self,
@@ -65,7 +116,7 @@ class ScriptExporterCharm(ops.CharmBase):
         # Make sure the exporter binary is present with a systemd service
         try:
             self._obtain_exporter(exporter_url=EXPORTER_BINARY_URL, binary_sha=EXPORTER_BINARY_SHA)
-        except HTTPError as e:
+        except (HTTPError, ValueError) as e:
             msg = "Script Exporter binary couldn't be downloaded - {}".format(str(e))
             logger.warning(msg)
             return
@@ -80,41 +131,54 @@ class ScriptExporterCharm(ops.CharmBase):
         if service_running("script-exporter"):
             service_stop("script-exporter")
 
-        os.remove(self._config_path)
-        try:
-            os.remove(self._script_path)
-        except FileNotFoundError:
-            pass
-        try:
-            os.remove(self._binary_path)
-        except FileNotFoundError:
-            pass
+        for path in (self._config_path, self._script_path, self._binary_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
     def on_config_changed(self, event: ops.ConfigChangedEvent):
         """Handle config changed event."""
-        if self.model.config["config_file"]:
-            self.write_file(self._config_path, str(self.model.config["config_file"]))
-        if self.model.config["script_file"]:
-            self.write_file(self._script_path, str(self.model.config["script_file"]))
+        config_file = cast(str, self.model.config["config_file"])
+        script_file = cast(str, self.model.config["script_file"])
+        changed = False
+        if config_file:
+            changed |= self.write_file(self._config_path, config_file)
+        if script_file:
+            changed |= self.write_file(self._script_path, script_file)
             os.chmod(self._script_path, 0o755)
-        service_restart("script-exporter.service")
+        # Only skip the restart when nothing changed on disk and the exporter is up: a
+        # failed restart leaves the service inactive, so a retried hook still restarts it
+        if changed or not service_running("script-exporter"):
+            service_restart("script-exporter.service")
         self.set_status()
 
-    def write_file(self, path: Union[str, Path], content: str) -> None:
-        """Write content to a file."""
+    def write_file(self, path: Union[str, Path], content: str) -> bool:
+        """Write content to a file, unless it already holds that exact content.
+
+        Returns:
+            a boolean representing whether the file has been written.
+        """
+        try:
+            with open(path) as f:
+                if f.read() == content:
+                    return False
+        except FileNotFoundError:
+            pass
+
         with open(path, "w") as f:
             f.write(content)
+        return True
 
     def set_status(self):
         """Calculate and set the unit status."""
-        if not self.model.config["config_file"]:
-            self.unit.status = ops.BlockedStatus('Please set the "config_file" config variable')
-        if not self.model.config["script_file"]:
-            self.unit.status = ops.BlockedStatus('Please set the "script_file" config variable')
-        elif not self.model.config["prometheus_config_file"]:
-            self.unit.status = ops.BlockedStatus(
-                'Please set the "prometheus_config_file" config variable'
-            )
+        config = self.model.config
+        if not config["config_file"]:
+            self.unit.status = NO_CONFIG_FILE_STATUS
+        elif not config["script_file"]:
+            self.unit.status = NO_SCRIPT_FILE_STATUS
+        elif not config["prometheus_config_file"]:
+            self.unit.status = NO_PROMETHEUS_CONFIG_FILE_STATUS
         else:
             self.unit.status = ops.ActiveStatus()
 
@@ -132,24 +196,12 @@ class ScriptExporterCharm(ops.CharmBase):
     def scripts_scraping_jobs(self):
         """The scraping jobs to execute scripts from Prometheus."""
         jobs = []
-        prometheus_scrape_jobs = str(self.model.config.get("prometheus_config_file"))
+        prometheus_scrape_jobs = cast(str, self.model.config.get("prometheus_config_file", ""))
         if prometheus_scrape_jobs:
-            scrape_jobs = yaml.safe_load(prometheus_scrape_jobs)
+            scrape_jobs = yaml.load(prometheus_scrape_jobs, Loader=SafeLoader)
             # Add the Script Exporter's `relabel_configs` to each job
             for scrape_job in scrape_jobs["scrape_configs"]:
-                # The relabel configs come from the official Script Exporter docs; please refer
-                # to that for further information on what they do
-                scrape_job["relabel_configs"] = [
-                    {"source_labels": ["__address__"], "target_label": "__param_target"},
-                    {"source_labels": ["__param_target"], "target_label": "instance"},
-                    # Copy the scrape job target to an extra label for dashboard usage
-                    {"source_labels": ["__param_target"], "target_label": "script_target"},
-                    # Set the address to scrape to the script exporter url
-                    {
-                        "target_label": "__address__",
-                        "replacement": f"localhost:{EXPORTER_PORT}",
-                    },
-                ]
+                scrape_job["relabel_configs"] = [dict(c) for c in RELABEL_CONFIGS]
                 jobs.append(scrape_job)
 
         return jobs
@@ -157,28 +209,10 @@ class ScriptExporterCharm(ops.CharmBase):
     # Methods around getting the Script Exporter binary
 
     def _create_service_if_not_existing(self) -> None:
-        """Create the systemd service for the exporter if missing."""
-        systemd_template = textwrap.dedent(
-            """
-            [Unit]
-            Description=Prometheus Script exporter
-            Wants=network-online.target
-            After=network-online.target
-
-            [Service]
-            LimitNPROC=infinity
-            LimitNOFILE=infinity
-            ExecStart=/usr/local/bin/script_exporter --config.file=/etc/script-exporter.yaml
-            Restart=always
-
-            [Install]
-            WantedBy=multi-user.target
-            """
-        )
-
-        with open("/etc/systemd/system/script-exporter.service", "w") as f:
-            f.write(systemd_template)
-
+        """Create the systemd service for the exporter if missing or outdated."""
+        # An unchanged unit file isn't rewritten, but systemd is always reloaded and the
+        # service enabled: a previous hook may have failed after writing the file
+        self.write_file(self._service_path, SYSTEMD_UNIT)
         daemon_reload()
         service_restart("script-exporter.service")
         # `enable --now`, but it's the only method which ACTUALLY enables it
@@ -196,7 +230,7 @@ class ScriptExporterCharm(ops.CharmBase):
         if not self._push_exporter_if_attached() and self._script_exporter_must_be_downloaded(
             binary_sha
         ):
-            self._download_exporter_binary(exporter_url)
+            self._download_exporter_binary(exporter_url, binary_sha)
 
     def _push_exporter_if_attached(self) -> bool:
         """Check whether Script Exporter binary is attached to the charm or not.
@@ -251,22 +285,19 @@ class ScriptExporterCharm(ops.CharmBase):
         """
         try:
             with open(file_path, "rb") as f:
-                file_bytes = f.read()
-                result = sha256(file_bytes).hexdigest()
-
-                if result != sha256sum:
-                    msg = "File sha256sum mismatch, expected:'{}' but got '{}'".format(
-                        sha256sum, result
-                    )
-                    logger.debug(msg)
-                    return False
-
-                return True
+                result = _file_sha256(f)
         except (APIError, FileNotFoundError):
             msg = "File: '{}' could not be opened".format(file_path)
             logger.error(msg)
             return False
 
+        if not hmac.compare_digest(result, sha256sum):
+            msg = "File sha256sum mismatch, expected:'{}' but got '{}'".format(sha256sum, result)
+            logger.debug(msg)
+            return False
+
+        return True
+
     def _is_exporter_binary_in_charm(self, binary_path: str) -> bool:
         """Check if Script Exporter binary is already stored locally.
 
@@ -278,21 +309,64 @@ class ScriptExporterCharm(ops.CharmBase):
         """
         return True if Path(binary_path).is_file() else False
 
-    def _download_exporter_binary(self, exporter_url: str) -> None:
+    def _download_exporter_binary(self, exporter_url: str, binary_sha: str) -> None:
         """Download the Script Exporter binary file and move it to its new location.
 
+        The binary is hashed while it is being downloaded, and only moved in place if its
+        sha256sum matches.
+
         Args:
             exporter_url: url where to get Script Exporter binary from
+            binary_sha: expected sha of the script exporter binary
+
+        Raises:
+            ValueError: if the downloaded binary doesn't match the expected sha.
+        """
+        digest = hashlib.sha256()
+        # Download next to the final location and move it in place once complete, so that
+        # an interrupted download never leaves a truncated binary behind
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(self._binary_path), prefix=".script_exporter-", delete=False
+        ) as f:
+            try:
+                with request.urlopen(exporter_url) as r:
+                    self._preallocate(f.fileno(), r.headers.get("Content-Length"))
+                    while chunk := r.read(READ_CHUNK_SIZE):
+                        digest.update(chunk)
+                        f.write(chunk)
+                # Drop any preallocated space the download didn't fill
+                f.truncate()
+                result = digest.hexdigest()
+                if not hmac.compare_digest(result, binary_sha):
+                    raise ValueError(
+                        "sha256sum mismatch, expected:'{}' but got '{}'".format(binary_sha, result)
+                    )
+                # Make sure the content is on disk before it replaces the current binary
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                os.remove(f.name)
+                raise
+        os.chmod(f.name, 0o755)
+        os.replace(f.name, self._binary_path)
+        logger.info(
+            "Script Exporter binary file has been downloaded and stored in: %s",
+            self._binary_path,
+        )
+
+    def _preallocate(self, fd: int, content_length: Optional[str]) -> None:
+        """Reserve disk space for a download of a known size, to avoid fragmenting the file.
+
+        Args:
+            fd: file descriptor of the file the download is written to
+            content_length: value of the Content-Length header of the download, if any
         """
-        with request.urlopen(exporter_url) as r:
-            file_bytes = r.read()
-            with open(self._binary_path, "wb") as f:
-                f.write(file_bytes)
-                logger.info(
-                    "Script Exporter binary file has been downloaded and stored in: %s",
-                    self._binary_path,
-                )
-                os.chmod(self._binary_path, 0o755)
+        if not content_length or not content_length.isdigit():
+            return
+        try:
+            os.posix_fallocate(fd, 0, int(content_length))
+        except OSError as e:
+            logger.debug("Disk space for the download couldn't be preallocated - %s", e)
 
 
 if __name__ == "__main__":  # pragma: nocover
@@ -1,9 +1,52 @@
 from unittest import mock
 
 import pytest
+from scenario import Context, Relation
 
+from charm import ScriptExporterCharm
 
-@pytest.fixture(autouse=True)
+
+@pytest.fixture(autouse=True, scope="session")
 def mock_snap():
     with mock.patch("charms.operator_libs_linux.v2.snap.SnapCache") as _fixture:
         yield _fixture
+
+
+@pytest.fixture(autouse=True, scope="module")
+def mock_service_restart():
+    # Tests inspecting the calls patch it themselves; a plain function avoids the MagicMock
+    # call machinery for all the others
+    with mock.patch("charm.service_restart", lambda *args, **kwargs: True) as _fixture:
+        yield _fixture
+
+
+@pytest.fixture(autouse=True, scope="module")
+def mock_service_running():
+    with mock.patch("charm.service_running", lambda *args, **kwargs: True) as _fixture:
+        yield _fixture
+
+
+@pytest.fixture
+def charm_paths(tmp_path, monkeypatch):
+    """Point the files managed by the charm to a temporary directory."""
+    original_init = ScriptExporterCharm.__init__
+
+    def redirected_init(self, *args):
+        original_init(self, *args)
+        self._script_path = str(tmp_path / "script-exporter-script")
+        self._config_path = str(tmp_path / "script-exporter-config.yaml")
+        self._binary_path = str(tmp_path / "script_exporter")
+        self._service_path = str(tmp_path / "script-exporter.service")
+
+    monkeypatch.setattr(ScriptExporterCharm, "__init__", redirected_init)
+    return tmp_path
+
+
+@pytest.fixture
+def ctx():
+    return Context(charm_type=ScriptExporterCharm)
+
+
+@pytest.fixture(scope="module")
+def cos_agent_relation():
+    return Relation("cos-agent", remote_app_name="grafana-agent")
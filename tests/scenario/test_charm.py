@@ -1,7 +1,14 @@
+import hashlib
+import io
 import json
-from unittest.mock import MagicMock, patch
+from dataclasses import replace
+from unittest.mock import patch
 
-from scenario import Context, Relation, State
+import pytest
+import yaml
+from charms.operator_libs_linux.v1.systemd import SystemdError
+from scenario import Context, State
+from scenario.runtime import UncaughtCharmError
 
 import charm
 
@@ -32,27 +39,117 @@ PROMETHEUS_CONFIG = """scrape_configs:
         replacement: ping
 """
 
+BINARY = b"#!/bin/sh\necho script_exporter\n"
+BINARY_SHA = hashlib.sha256(BINARY).hexdigest()
 
-@patch("charm.service_restart", MagicMock(return_value=True))
-def test_status_no_script():
-    context = Context(charm_type=charm.ScriptExporterCharm)
-    state = State(config={"config_file": "", "script_file": "", "prometheus_config_file": ""})
-    state_out = context.run(event="config-changed", state=state)
+# Parsed once, for the tests to assert against
+PROMETHEUS_SCRAPE_JOBS = yaml.safe_load(PROMETHEUS_CONFIG)["scrape_configs"]
+
+CONFIG = {
+    "config_file": EXAMPLE_CONFIG,
+    "script_file": EXAMPLE_SCRIPT,
+    "prometheus_config_file": PROMETHEUS_CONFIG,
+}
+# Fully configured unit, which tests derive their own state from
+BASE_STATE = State(config=CONFIG)
+
+
+def _scrape_jobs(state_out):
+    """Return the scrape jobs the charm published over the cos-agent relation."""
+    return json.loads(state_out.relations[0].local_unit_data["config"])["metrics_scrape_jobs"]
+
+
+def test_status_no_script(ctx):
+    state = replace(BASE_STATE, config=dict.fromkeys(CONFIG, ""))
+    state_out = ctx.run(event="config-changed", state=state)
+    assert state_out.unit_status.name == "blocked"
+
+
+@pytest.mark.parametrize("missing", ["config_file", "script_file", "prometheus_config_file"])
+def test_status_missing_config(ctx, missing):
+    state = replace(BASE_STATE, config={**CONFIG, missing: ""})
+    state_out = ctx.run(event="start", state=state)
     assert state_out.unit_status.name == "blocked"
+    assert f'"{missing}"' in state_out.unit_status.message
+
+
+def test_cos_agent_relation_data_is_set(ctx, cos_agent_relation):
+    state = replace(BASE_STATE, relations=[cos_agent_relation])
+    state_out = ctx.run(event=cos_agent_relation.changed_event, state=state)
+
+    scrape_jobs = _scrape_jobs(state_out)
+    # The self-monitoring job, plus one per scrape job in `prometheus_config_file`
+    assert len(scrape_jobs) == 1 + len(PROMETHEUS_SCRAPE_JOBS)
+    job_names = [job["job_name"] for job in scrape_jobs]
+    for scrape_job in PROMETHEUS_SCRAPE_JOBS:
+        assert any(name.endswith(scrape_job["job_name"]) for name in job_names)
+
+
+def test_config_changed_restarts_on_new_files(ctx, charm_paths):
+    with patch("charm.service_restart") as service_restart:
+        ctx.run(event="config-changed", state=BASE_STATE)
+    service_restart.assert_called_once()
+    assert (charm_paths / "script-exporter-config.yaml").read_text() == EXAMPLE_CONFIG
+    assert (charm_paths / "script-exporter-script").read_text() == EXAMPLE_SCRIPT
+
+
+def test_config_changed_skips_restart_on_unchanged_files(ctx, charm_paths):
+    (charm_paths / "script-exporter-config.yaml").write_text(EXAMPLE_CONFIG)
+    (charm_paths / "script-exporter-script").write_text(EXAMPLE_SCRIPT)
+    with patch("charm.service_restart") as service_restart:
+        ctx.run(event="config-changed", state=BASE_STATE)
+    service_restart.assert_not_called()
+
+
+def test_config_changed_restarts_on_retry_after_failed_restart(charm_paths):
+    failing_restart = patch("charm.service_restart", side_effect=SystemdError("failed"))
+    with failing_restart, pytest.raises(UncaughtCharmError):
+        Context(charm_type=charm.ScriptExporterCharm).run(event="config-changed", state=BASE_STATE)
+    assert (charm_paths / "script-exporter-config.yaml").read_text() == EXAMPLE_CONFIG
+
+    # The files are now up to date, but the failed restart left the exporter inactive
+    with patch("charm.service_restart") as service_restart, patch(
+        "charm.service_running", return_value=False
+    ):
+        Context(charm_type=charm.ScriptExporterCharm).run(event="config-changed", state=BASE_STATE)
+    service_restart.assert_called_once()
+
+
+class _Response(io.BytesIO):
+    """Minimal stand-in for the response returned by `urllib.request.urlopen`."""
+
+    headers = {}
+
+
+@pytest.fixture
+def no_binary_resource():
+    # Scenario can't represent a declared but unattached resource, which Juju reports
+    # with a ModelError
+    with patch.object(charm.ScriptExporterCharm, "_push_exporter_if_attached", return_value=False):
+        yield
+
+
+def test_install_downloads_exporter_binary(ctx, charm_paths, no_binary_resource):
+    with patch("charm.EXPORTER_BINARY_SHA", BINARY_SHA), patch(
+        "urllib.request.urlopen", lambda url: _Response(BINARY)
+    ):
+        ctx.run(event="install", state=BASE_STATE)
+
+    binary = charm_paths / "script_exporter"
+    assert binary.read_bytes() == BINARY
+    assert binary.stat().st_mode & 0o777 == 0o755
+    assert not list(charm_paths.glob(".script_exporter-*"))
+
+
+def test_install_rejects_exporter_binary_with_wrong_sha(ctx, charm_paths, no_binary_resource):
+    binary = charm_paths / "script_exporter"
+    binary.write_bytes(b"previous binary")
 
+    with patch("charm.EXPORTER_BINARY_SHA", BINARY_SHA), patch(
+        "urllib.request.urlopen", lambda url: _Response(b"tampered binary")
+    ):
+        ctx.run(event="install", state=BASE_STATE)
 
-def test_cos_agent_relation_data_is_set():
-    cos_agent_relation = Relation("cos-agent", remote_app_name="grafana-agent")
-    context = Context(charm_type=charm.ScriptExporterCharm)
-    state = State(
-        relations=[cos_agent_relation],
-        config={
-            "config_file": EXAMPLE_CONFIG,
-            "script_file": EXAMPLE_SCRIPT,
-            "prometheus_config_file": PROMETHEUS_CONFIG,
-        },
-    )
-    state_out = context.run(event=cos_agent_relation.changed_event, state=state)
-
-    relation_data = json.loads(state_out.relations[0].local_unit_data["config"])
-    assert len(relation_data["metrics_scrape_jobs"]) == 2
+    # The mismatch is logged by the install hook, and leaves the current binary untouched
+    assert binary.read_bytes() == b"previous binary"
+    assert not list(charm_paths.glob(".script_exporter-*"))